@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
+import collections
 import dataclasses
-from typing import Optional, Self
+import enum
+import functools
+import hashlib
+import importlib.metadata
+import json
+from typing import Any, Callable, Optional, Self
 
 import click
 import jinja2
@@ -10,6 +16,34 @@ import pathlib
 import diff
 import machine_configs
 
+_BYTECODE_CACHE_DIR = pathlib.Path(__file__).parent / ".jinja_cache"
+_DEPLOY_CACHE_PATH = pathlib.Path(__file__).parent / ".deploy_cache.json"
+# Bump whenever how templates are rendered changes, e.g. `TemplateFile.rendered` or the environment's options, so
+# outputs cached by older versions are checked again.
+_DEPLOY_CACHE_VERSION = 1
+
+
+def create_environment(
+    config_dir: pathlib.Path, variables: dict[str, Any]
+) -> jinja2.Environment:
+    """Create the Jinja environment for rendering templates under `config_dir` with `variables`.
+
+    Compiled templates are cached on disk where possible, so later runs skip parsing templates that haven't changed.
+    """
+    try:
+        _BYTECODE_CACHE_DIR.mkdir(exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(str(_BYTECODE_CACHE_DIR))
+    except OSError:
+        # E.g. a read-only checkout: just compile templates from scratch.
+        bytecode_cache = None
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(searchpath=str(config_dir)),
+        undefined=jinja2.StrictUndefined,
+        bytecode_cache=bytecode_cache,
+    )
+    env.globals.update(variables)  # type: ignore
+    return env
+
 
 def load_or_create_configuration_file(
     path: pathlib.Path,
@@ -40,38 +74,49 @@ class TemplateFile:
     output_path: pathlib.Path
     template: jinja2.Template
 
-    @property
+    @functools.cached_property
     def template_path(self) -> pathlib.Path:
         assert self.template.filename is not None
         return pathlib.Path(self.template.filename)
 
-    def render(self) -> str:
+    @functools.cached_property
+    def rendered(self) -> str:
         # Jinja seems to strip the trailing newline, leaving diff artefacts.
         return self.template.render() + "\n"
 
-    def read_existing(self) -> Optional[str]:
+    @functools.cached_property
+    def rendered_bytes(self) -> bytes:
+        return self.rendered.encode("utf-8")
+
+    @functools.cached_property
+    def existing_bytes(self) -> Optional[bytes]:
         try:
-            return self.output_path.read_text()
+            return self.output_path.read_bytes()
         except FileNotFoundError:
             return None
 
     def has_diff(self) -> bool:
-        # Special case: if the generated file is empty, don't create the file if it doesn't already exist.
-        # This allows for not installing e.g. a bashrc config if the shell isn't bash - we just make the
-        # file empty.
-        if self.render().strip() == "" and not self.output_path.exists():
-            return False
-        return self.read_existing() != self.render()
+        try:
+            existing_size = self.output_path.stat().st_size
+        except FileNotFoundError:
+            # Special case: if the generated file is empty, don't create the file if it doesn't already exist.
+            # This allows for not installing e.g. a bashrc config if the shell isn't bash - we just make the
+            # file empty.
+            return self.rendered.strip() != ""
+        # Files of different sizes must differ, without needing to read the destination.
+        if existing_size != len(self.rendered_bytes):
+            return True
+        # Compare raw bytes, so unchanged files don't need decoding.
+        return self.existing_bytes != self.rendered_bytes
 
     def print_diff(self, context_lines: int):
-        existing = self.read_existing() or ""
+        existing = (self.existing_bytes or b"").decode("utf-8", errors="replace")
         print(f"Diff to apply from '{self.template_path}' to '{self.output_path}':")
-        diff.pretty_print(
-            diff.diff(existing, self.render()), context_lines=context_lines
-        )
+        diff.pretty_print(diff.diff(existing, self.rendered, context_lines))
 
     def write_output_path(self):
-        self.output_path.write_text(self.render())
+        self.output_path.write_bytes(self.rendered_bytes)
+
     def write_template_path(self):
         self.template_path.write_bytes(self.output_path.read_bytes())
 
@@ -80,13 +125,129 @@ class TemplateFile:
         cls,
         env: jinja2.Environment,
         output_dir: pathlib.Path,
-        template_path: pathlib.Path,
+        template_name: str,
     ) -> Self:
-        template = env.get_template(str(template_path))
-        output_path = output_dir.joinpath(*template_path.parts[1:])
+        template = env.get_template(template_name)
+        # Strip the top-level directory, which just groups related configs.
+        output_path = output_dir.joinpath(template_name.partition("/")[2])
         return cls(output_path, template)
 
 
+@dataclasses.dataclass
+class DeployCache:
+    """Modification times of templates whose output was last seen to be up to date.
+
+    If neither the template nor its output has been touched since, and the template variables and rendering code are
+    the same, the output must still be up to date so rendering can be skipped entirely.
+    """
+
+    path: pathlib.Path
+    inputs_hash: str
+    # `{template_path: [output_path, template_mtime_ns, output_mtime_ns]}`
+    entries: dict[str, list[str | int]]
+
+    @classmethod
+    def load(cls, path: pathlib.Path, variables: dict[str, Any]) -> Self:
+        render_inputs = {
+            "version": _DEPLOY_CACHE_VERSION,
+            "jinja2": importlib.metadata.version("jinja2"),
+            "variables": variables,
+        }
+        inputs_hash = hashlib.sha256(
+            json.dumps(render_inputs, sort_keys=True, default=sorted).encode()
+        ).hexdigest()
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            # Missing, unreadable or corrupt: the cache is disposable, so start afresh.
+            data = {}
+        if (
+            not isinstance(data, dict)
+            or data.get("inputs_hash") != inputs_hash
+            or not isinstance(data.get("entries"), dict)
+        ):
+            data = {"entries": {}}
+        return cls(path, inputs_hash, data["entries"])
+
+    def save(self):
+        try:
+            self.path.write_text(
+                json.dumps({"inputs_hash": self.inputs_hash, "entries": self.entries})
+            )
+        except OSError:
+            # E.g. a read-only checkout: the cache is only an optimisation.
+            pass
+
+    @staticmethod
+    def _entry(file: TemplateFile) -> Optional[list[str | int]]:
+        try:
+            return [
+                str(file.output_path),
+                file.template_path.stat().st_mtime_ns,
+                file.output_path.stat().st_mtime_ns,
+            ]
+        except FileNotFoundError:
+            return None
+
+    def is_up_to_date(self, file: TemplateFile) -> bool:
+        entry = self._entry(file)
+        return entry is not None and self.entries.get(str(file.template_path)) == entry
+
+    def record_up_to_date(self, file: TemplateFile):
+        if (entry := self._entry(file)) is not None:
+            self.entries[str(file.template_path)] = entry
+
+
+class Action(enum.Enum):
+    """What to do with a template after handling a command for it."""
+
+    # Re-render the template and show the diff again.
+    REFRESH = enum.auto()
+    # Move on to the next template.
+    NEXT = enum.auto()
+    QUIT = enum.auto()
+
+
+def _confirm() -> bool:
+    print("Are you sure? [y/n]")
+    return click.getchar() == "y"
+
+
+def _edit(file: TemplateFile) -> Action:
+    click.edit(filename=[str(file.template_path), str(file.output_path)])
+    return Action.REFRESH
+
+
+def _overwrite_destination(file: TemplateFile) -> Action:
+    if not _confirm():
+        return Action.REFRESH
+    file.write_output_path()
+    return Action.NEXT
+
+
+def _overwrite_template(file: TemplateFile) -> Action:
+    if not _confirm():
+        return Action.REFRESH
+    file.write_template_path()
+    return Action.NEXT
+
+
+def _clear(file: TemplateFile) -> Action:
+    click.clear()
+    return Action.REFRESH
+
+
+_COMMANDS: dict[str, Callable[[TemplateFile], Action]] = {
+    "e": _edit,
+    "r": lambda _: Action.REFRESH,
+    "s": lambda _: Action.NEXT,
+    "o": _overwrite_destination,
+    "t": _overwrite_template,
+    "c": _clear,
+    "q": lambda _: Action.QUIT,
+}
+
+
 @click.command()
 @click.option(
     "--machine_config_file",
@@ -123,54 +284,58 @@ def main(
 ):
     if not (machine_config := load_or_create_configuration_file(machine_config_file)):
         return
-    should_install_directory = machine_configs.should_install_directory(machine_config)
+    skipped_directories = machine_configs.skipped_directories(machine_config)
 
-    loader = jinja2.FileSystemLoader(searchpath=str(config_dir))
-    env = jinja2.Environment(loader=loader, undefined=jinja2.StrictUndefined)
-    env.globals.update(machine_config.as_template_variables())  # type: ignore
+    variables = machine_config.as_template_variables()
+    env = create_environment(config_dir, variables)
+    cache = DeployCache.load(_DEPLOY_CACHE_PATH, variables)
 
-    for template_name in loader.list_templates():
-        template_path = pathlib.Path(template_name)
-        if template_path.is_absolute():
-            raise ValueError(f"Unsupported absolute template path: {template_path}")
+    templates_by_directory = collections.defaultdict[str, list[str]](list)
+    for template_name in env.list_templates():
+        templates_by_directory[template_name.partition("/")[0]].append(template_name)
 
-        # Skip directories where the installation condition isn't met.
-        if not should_install_directory.get(template_path.parts[0], True):
-            continue
+    try:
+        for directory, template_names in templates_by_directory.items():
+            # Skip directories where the installation condition isn't met.
+            if directory in skipped_directories:
+                continue
 
-        while True:
-            try:
-                file = TemplateFile.create(env, output_dir, template_path)
-            except Exception as e:
-                raise RuntimeError(f"Failed while loading {template_name}") from e
-            if not file.has_diff():
-                break
+            for template_name in template_names:
+                if template_name.startswith("/"):
+                    raise ValueError(
+                        f"Unsupported absolute template path: {template_name}"
+                    )
 
-            file.print_diff(diff_context_lines)
+                while True:
+                    try:
+                        file = TemplateFile.create(env, output_dir, template_name)
+                    except Exception as e:
+                        raise RuntimeError(
+                            f"Failed while loading {template_name}"
+                        ) from e
+                    if cache.is_up_to_date(file):
+                        break
+                    if not file.has_diff():
+                        cache.record_up_to_date(file)
+                        break
 
-            if diff_only:
-                break
+                    file.print_diff(diff_context_lines)
 
-            print("[e]dit, [r]efresh, [s]kip, [o]verwrite destination, overwrite [t]emplate, [c]lear, [q]uit")
-            command = click.getchar()
-            if command == "e":
-                click.edit(filename=[str(file.template_path), str(file.output_path)])
-            elif command == "r":
-                continue
-            elif command == "s":
-                break
-            elif command == "o" or command == "t":
-                print("Are you sure? [y/n]")
-                if click.getchar() == "y":
-                    if command == "o":
-                        file.write_output_path()
-                    else:
-                        file.write_template_path()
-                    break
-            elif command == "c":
-                click.clear()
-            elif command == "q":
-                return
+                    if diff_only:
+                        break
+
+                    print(
+                        "[e]dit, [r]efresh, [s]kip, [o]verwrite destination, overwrite [t]emplate, [c]lear, [q]uit"
+                    )
+                    if not (command := _COMMANDS.get(click.getchar())):
+                        continue
+                    action = command(file)
+                    if action == Action.NEXT:
+                        break
+                    elif action == Action.QUIT:
+                        return
+    finally:
+        cache.save()
 
 
 if __name__ == "__main__":
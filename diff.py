@@ -1,33 +1,56 @@
 import difflib
-
-
-def diff(a: str, b: str) -> list[str]:
-    return list(difflib.ndiff(a.splitlines(keepends=True), b.splitlines(keepends=True)))
-
-
-def pretty_print(diff: list[str], context_lines: int = 2):
-    relevant_lines = set[int]()
-    for i, line in enumerate(diff):
-        if not line.startswith("  "):
-            relevant_lines.update(range(i - context_lines, i + context_lines))
-
-    last_i = None
-    for i in sorted(relevant_lines):
-        if i < 0 or i >= len(diff):
+import sys
+
+# Colour each line by its diff marker. Reset to the terminal's default colour afterwards, rather than assuming white.
+_COLOURS = {"-": b"\033[38;2;255;0;0m", "+": b"\033[38;2;0;255;0m"}
+_RESET = b"\033[0m"
+
+
+def diff(a: str, b: str, context_lines: int = 2) -> list[str]:
+    if a == b:
+        return []
+    return list(
+        difflib.unified_diff(
+            a.splitlines(keepends=True),
+            b.splitlines(keepends=True),
+            n=context_lines,
+            lineterm="",
+        )
+    )
+
+
+def pretty_print(diff: list[str]):
+    output = bytearray()
+    # Skip the `---`/`+++` file headers, and show a marker between hunks in place of their `@@` headers.
+    first_hunk = True
+    for line in diff[2:]:
+        if line.startswith("@@"):
+            if not first_hunk:
+                output += b"...\n"
+            first_hunk = False
             continue
-
-        # If we've skipped a range, show a marker
-        if last_i is not None and i != last_i + 1:
-            print("...")
-        print(_format_colourful(diff[i]), end="")
-        last_i = i
-    print()
-
-
-def _format_colourful(line: str) -> str:
-    if line.startswith("-"):
-        return f"\033[38;2;255;0;0m{line}\033[38;2;255;255;255m"
-    elif line.startswith("+"):
-        return f"\033[38;2;0;255;0m{line}\033[38;2;255;255;255m"
-    else:
-        return line
+        # Lines keep their endings so that changes to just the endings still show up in the diff; make those visible.
+        text, newline = _split_line_ending(line)
+        if colour := _COLOURS.get(text[:1]):
+            output += colour
+            output += text.encode()
+            output += _RESET
+        else:
+            output += text.encode()
+        output += b"\n"
+        if not newline:
+            output += b"\\ No newline at end of file\n"
+    output += b"\n"
+
+    # Write everything at once, after anything already buffered by `print`.
+    sys.stdout.flush()
+    sys.stdout.buffer.write(output)
+
+
+def _split_line_ending(line: str) -> tuple[str, str]:
+    """Split a diff line into its text and line ending, showing carriage returns as `^M` like git."""
+    text = line.splitlines()[0]
+    newline = line[len(text) :]
+    if newline == "\r\n":
+        return text + "^M", newline
+    return text, newline
@@ -1,24 +1,29 @@
 from typing import Any
 
 import dataclasses
+import functools
 import os
-import pathlib
 
 
-def _get_path_binaries() -> set[str]:
+@functools.cache
+def _get_path_binaries() -> frozenset[str]:
     """Get all binaries accessible from `$PATH`."""
     binaries = set[str]()
     for dir in os.environ["PATH"].split(":"):
-        p = pathlib.Path(dir)
-        if not p.is_dir():
+        try:
+            entries = os.scandir(dir)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
             continue
-        for e in p.iterdir():
-            if e.is_file() and os.access(e, os.X_OK):
-                binaries.add(e.name)
-    return binaries
-
-
-_PATH_BINARIES = frozenset(_get_path_binaries())
+        with entries:
+            for e in entries:
+                # Follow symlinks: on e.g. Nix most binaries on `$PATH` are links into the store.
+                try:
+                    if e.is_file() and e.stat().st_mode & 0o111:
+                        binaries.add(e.name)
+                except OSError:
+                    # E.g. symlink loops or files removed mid-scan.
+                    continue
+    return frozenset(binaries)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -31,11 +36,16 @@ class MachineConfig:
     primary_display: str
     statusbar_displays: frozenset[str]
     other_displays: frozenset[str]
-    path_binaries: frozenset[str] = _PATH_BINARIES
+
+    @property
+    def path_binaries(self) -> frozenset[str]:
+        # Scanning `$PATH` is slow, so only do it once something needs it.
+        return _get_path_binaries()
 
     def as_template_variables(self) -> dict[str, Any]:
         """Get variables as a dict of the form `{"KEY": <typed value>, ...}`."""
-        return {k.upper(): v for k, v in dataclasses.asdict(self).items()}
+        variables = dataclasses.asdict(self) | {"path_binaries": self.path_binaries}
+        return {k.upper(): v for k, v in variables.items()}
 
 
 MACHINE_CONFIGS: dict[str, MachineConfig] = {
@@ -62,8 +72,9 @@ MACHINE_CONFIGS: dict[str, MachineConfig] = {
 }
 
 
-def should_install_directory(config: MachineConfig) -> dict[str, bool]:
-    return {
+def skipped_directories(config: MachineConfig) -> frozenset[str]:
+    """Get the top-level config directories that shouldn't be installed on this machine."""
+    should_install = {
         "bashrc": config.shell == "bash",
         "dunst": "dunst" in config.path_binaries,
         "i3": "i3" in config.path_binaries,
@@ -74,3 +85,4 @@ def should_install_directory(config: MachineConfig) -> dict[str, bool]:
         "xmodmap": config.work,
         "xsession": config.work,
     }
+    return frozenset(d for d, install in should_install.items() if not install)